@@ -0,0 +1,395 @@
+import os
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import bisect
+from collections import defaultdict
+import logging
+import gspread
+import orjson
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# Google Sheets access scopes
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+# Timezone
+SG_TIME = ZoneInfo("Asia/Singapore")
+# Timestamp format of the Logs sheet; /report and log_day() rely on the dd/mm/YYYY prefix
+LOG_TIME_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# Formatted SG time, reformatted at most once per second
+_now_cache = (None, "")
+
+def now_str():
+    global _now_cache
+    second = int(time.time())
+    if _now_cache[0] != second:
+        _now_cache = (second, datetime.now(SG_TIME).strftime(LOG_TIME_FORMAT))
+    return _now_cache[1]
+
+# Access sheets, authorizing on first use rather than at import
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet():
+    creds_json = os.getenv("GOOGLE_SHEET_CREDENTIALS")
+    if not creds_json:
+        raise Exception("GOOGLE_SHEET_CREDENTIALS environment variable not set.")
+
+    creds_dict = orjson.loads(creds_json)
+    # Env vars often carry the key's newlines as literal backslash-n sequences
+    creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    # One pooled keep-alive session shared by all Sheets worker threads
+    session = AuthorizedSession(creds)
+    # raise_on_status=False hands the last 429/5xx back to gspread, which raises it as APIError
+    retry = Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 503), raise_on_status=False)
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry))
+    client = gspread.Client(auth=creds, session=session)
+    try:
+        return client.open("PokemonInventory")
+    except Exception as e:
+        raise Exception(f"Failed to access Google Sheet: {e}")
+
+@functools.lru_cache(maxsize=1)
+def get_inv():
+    return get_spreadsheet().worksheet("Inventory")
+
+@functools.lru_cache(maxsize=1)
+def get_log():
+    return get_spreadsheet().worksheet("Logs")
+
+# gspread is blocking; all Sheets calls run on this small pool instead of the event loop
+_pool = ThreadPoolExecutor(max_workers=8)
+
+async def sheets(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_pool, functools.partial(fn, *args, **kwargs))
+
+# Inventory rows as [product, stock_type, qty]; UNFORMATTED_VALUE returns quantities as numbers
+def _inventory_rows(values):
+    rows = []
+    for r in values:
+        product, stock_type, qty = (r + ["", "", ""])[:3]
+        rows.append([str(product), str(stock_type), qty])
+    return rows
+
+# Quantity cell -> number, or None when it isn't one (e.g. "N/A"); blank counts as 0
+def _parse_qty(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    value = str(value).strip()
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+# A Quantity cell that isn't a number can't take a delta; the handlers ask for a fix in the sheet
+class BadQuantity(Exception):
+    pass
+
+# Cache the Inventory rows for a few seconds so reads don't hit Sheets every time
+class SheetCache:
+    def __init__(self, get_ws, ttl=30, overrides=None):
+        self._get_ws = get_ws
+        # row -> quantity written but not yet confirmed, replayed over every refetch
+        self._overrides = overrides if overrides is not None else {}
+        self._ttl = ttl
+        self._t = 0
+        self._data = None
+        self._index = None
+        self._by_product = None
+        # Bumped by invalidate(), so a fetch can tell it was overtaken by a failed write
+        self._gen = 0
+        # Writes made while a fetch is out, replayed onto its rows
+        self._journal = None
+        self._lock = asyncio.Lock()
+
+    async def records(self):
+        async with self._lock:
+            while self._data is None or time.monotonic() - self._t > self._ttl:
+                gen = self._gen
+                # The GET may or may not see writes that land while it is out, so replay
+                # everything unconfirmed at the start plus every write made during it
+                replay = [(row, None, None, qty) for row, qty in self._overrides.items()]
+                self._journal = replay
+                try:
+                    rows = _inventory_rows(await sheets(lambda: self._get_ws().get('A2:C', value_render_option='UNFORMATTED_VALUE')))
+                finally:
+                    self._journal = None
+                if self._gen != gen:
+                    # A batch failed mid-fetch, so some replayed quantities were never written
+                    continue
+                self._data = rows
+                self._index = None
+                self._by_product = None
+                for write in replay:
+                    self._apply(*write)
+                self._t = time.monotonic()
+            return self._data
+
+    def prime(self, rows):
+        self._data = rows
+        self._index = None
+        self._by_product = None
+        for row, qty in self._overrides.items():
+            self._put(row, qty)
+        self._t = time.monotonic()
+
+    # Lookup tables over the records, rebuilt only when the records refresh
+    async def _build_indexes(self):
+        records = await self.records()
+        if self._index is None:
+            index, by_product = {}, defaultdict(list)
+            for i, r in enumerate(records, start=2):
+                qty = _parse_qty(r[2])
+                if qty is None:
+                    logging.warning(f"Inventory row {i} has a non-numeric Quantity: {r[2]!r}")
+                index[(r[0], r[1])] = (i, qty)
+                by_product[r[0]].append(r)
+            self._index, self._by_product = index, by_product
+
+    # (product, stock_type) -> (row, qty)
+    async def index(self):
+        await self._build_indexes()
+        return self._index
+
+    # product -> its records, one per stock type
+    async def by_product(self):
+        await self._build_indexes()
+        return self._by_product
+
+    # Sorted unique product names from the cached records, so the buttons match by_product()
+    async def product_names(self):
+        return sorted({r[0] for r in await self.records()} - {""})
+
+    # Apply a write to the cached rows so the next read doesn't refetch
+    def set_quantity(self, row, product, stock_type, qty):
+        if self._journal is not None:
+            self._journal.append((row, product, stock_type, qty))
+        if self._data is not None and not self._apply(row, product, stock_type, qty):
+            self.invalidate()
+
+    # Set a row's quantity, or add the row just appended after the cached ones; False if neither fits
+    def _apply(self, row, product, stock_type, qty):
+        if row - 2 != len(self._data) or product is None:
+            return self._put(row, qty)
+        record = [product, stock_type, qty]
+        self._data.append(record)
+        if self._by_product is not None:
+            self._by_product[product].append(record)
+        if self._index is not None:
+            self._index[(product, stock_type)] = (row, qty)
+        return True
+
+    # Set the quantity of a cached row; False when the row isn't cached
+    def _put(self, row, qty):
+        i = row - 2
+        if i >= len(self._data):
+            return False
+        record = self._data[i]
+        record[2] = qty
+        if self._index is not None:
+            self._index[(record[0], record[1])] = (row, qty)
+        return True
+
+    def invalidate(self):
+        self._gen += 1
+        self._data = None
+        self._index = None
+        self._by_product = None
+
+# Quantities handed to write_quantity whose batchUpdate hasn't finished yet
+unsettled_qty = {}
+
+inv_cache = SheetCache(get_inv, overrides=unsettled_qty)
+
+LOG_COLUMNS = ["Timestamp", "Action", "Product", "Stock Type", "Quantity", "User", "Note"]
+
+# Today's log rows, seeded from the sheet at startup or on first use and then kept in step by log_action
+day_logs = []
+day_logs_loaded = False
+
+# "dd/mm/YYYY ..." -> YYYYMMDD, so days compare as plain ints
+def log_day(timestamp):
+    try:
+        d, m, y = timestamp[:10].split("/")
+        return int(y) * 10000 + int(m) * 100 + int(d)
+    except ValueError:
+        return 0
+
+# day_logs only ever holds one day's rows, so checking the first one is enough
+async def todays_logs():
+    if not day_logs_loaded:
+        await load_day_logs()
+    if day_logs and log_day(day_logs[0]['Timestamp']) == log_day(now_str()):
+        return day_logs
+    return []
+
+# Logs are appended in time order, so today's rows are a tail found by binary search on column A
+def _fetch_day_logs(today, stamps):
+    first = bisect.bisect_left(stamps, log_day(today), lo=1, key=log_day)
+    if first == len(stamps):
+        return []
+    rows = get_log().get(f"A{first + 1}:G{len(stamps)}")
+    return [dict(zip(LOG_COLUMNS, r + [""] * (len(LOG_COLUMNS) - len(r)))) for r in rows]
+
+# Seed day_logs from the sheet plus rows still waiting in log_queue
+async def load_day_logs():
+    global day_logs_loaded
+    # No flush may run meanwhile, or a row could be in both the sheet read and the queue, or neither
+    async with log_flush_lock:
+        if day_logs_loaded:
+            return
+        today = now_str()[:10]
+        stamps = await sheets(lambda: [str(v) for v in get_log().col_values(1, value_render_option='UNFORMATTED_VALUE')])
+        rows = await sheets(_fetch_day_logs, today, stamps)
+        async with log_lock:
+            queued = [dict(zip(LOG_COLUMNS, r)) for r in log_queue if log_day(r[0]) == log_day(today)]
+        day_logs[:] = rows + queued
+        day_logs_loaded = True
+
+# Warm the inventory cache and today's logs, reading both sheets in one values.batchGet
+async def warm_caches():
+    global day_logs_loaded
+    today = now_str()[:10]
+    result = await sheets(lambda: get_spreadsheet().values_batch_get(
+        ["Inventory!A2:C", "Logs!A:A"], params={"valueRenderOption": "UNFORMATTED_VALUE"}
+    ))
+    inv_values, log_values = (r.get("values", []) for r in result["valueRanges"])
+    inv_cache.prime(_inventory_rows(inv_values))
+    stamps = [str(v[0]) if v else "" for v in log_values]
+    day_logs[:] = await sheets(_fetch_day_logs, today, stamps)
+    day_logs_loaded = True
+
+# Pending log rows, written to the Logs sheet in bulk by flush_logs
+log_queue = []
+log_lock = asyncio.Lock()
+# Flush early once this many rows are waiting, without waiting for the next timer tick
+LOG_FLUSH_SIZE = 25
+log_flush_task = None
+
+# Log inventory changes
+async def log_action(action, product, qty, user, stock_type, note=""):
+    now = now_str()
+    row = [now, action, product, stock_type, qty, f"@{user}", note]
+    async with log_lock:
+        log_queue.append(row)
+        queued = len(log_queue)
+    global log_flush_task
+    if queued >= LOG_FLUSH_SIZE and (log_flush_task is None or log_flush_task.done()):
+        log_flush_task = asyncio.create_task(flush_logs())
+    if not day_logs_loaded:
+        # The seed picks this row up from the queue or, once flushed, from the sheet
+        try:
+            await load_day_logs()
+        except Exception as e:
+            logging.error(f"Loading today's logs failed: {e}")
+        return
+    if day_logs and log_day(day_logs[0]['Timestamp']) != log_day(now):
+        day_logs.clear()
+    day_logs.append(dict(zip(LOG_COLUMNS, row)))
+
+# One append at a time, so rows (and requeued rows) land in the order they were logged
+log_flush_lock = asyncio.Lock()
+
+async def flush_logs(context=None):
+    async with log_flush_lock:
+        async with log_lock:
+            if not log_queue:
+                return
+            rows = log_queue[:]
+            log_queue.clear()
+        try:
+            await sheets(lambda: get_log().append_rows(rows))
+        except Exception as e:
+            logging.error(f"Log flush failed: {e}")
+            async with log_lock:
+                log_queue[:0] = rows
+
+# Quantity writes that arrive while a batchUpdate is in flight are sent together in the next one.
+# A failed batch bumps qty_epoch: a batch queued behind it was computed on its values, so it fails too
+qty_epoch = 0
+qty_failure = None
+qty_inflight = None
+qty_next = None  # (task, {row: qty}, epoch)
+
+# Drop a finished batch's quantities from the overlay, unless a later write has replaced them
+def _settle(batch):
+    for row, qty in batch.items():
+        if unsettled_qty.get(row) == qty:
+            del unsettled_qty[row]
+
+async def _flush_quantities(batch, epoch):
+    global qty_inflight, qty_next, qty_epoch, qty_failure
+    if qty_inflight:
+        await asyncio.wait([qty_inflight])
+    if qty_next and qty_next[1] is batch:
+        qty_next = None
+    try:
+        if epoch != qty_epoch:
+            raise qty_failure
+        qty_inflight = asyncio.current_task()
+        data = [{"range": f"Inventory!C{row}", "values": [[qty]]} for row, qty in batch.items()]
+        await sheets(
+            lambda: get_spreadsheet().values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+        )
+    except Exception as e:
+        if epoch == qty_epoch:
+            qty_epoch += 1
+            qty_failure = e
+        inv_cache.invalidate()
+        raise
+    finally:
+        _settle(batch)
+
+async def write_quantity(row, qty):
+    global qty_next
+    if qty_next is None or qty_next[2] != qty_epoch:
+        batch = {}
+        qty_next = (asyncio.create_task(_flush_quantities(batch, qty_epoch)), batch, qty_epoch)
+    qty_next[1][row] = qty
+    unsettled_qty[row] = qty
+    await asyncio.shield(qty_next[0])
+
+async def _append_product(product, stock_type, delta):
+    result = await sheets(lambda: get_inv().append_rows([[product, stock_type, delta]]))
+    # updatedRange looks like "Inventory!A7:C7"
+    first_cell = result['updates']['updatedRange'].split('!')[-1].split(':')[0]
+    row, _ = gspread.utils.a1_to_rowcol(first_cell)
+    inv_cache.set_quantity(row, product, stock_type, delta)
+
+# One append per new (product, stock_type); concurrent callers wait for it, then update that row
+append_locks = defaultdict(asyncio.Lock)
+
+# Update inventory count
+async def update_inventory(product, stock_type, delta):
+    key = (product, stock_type)
+    hit = (await inv_cache.index()).get(key)
+    if not hit:
+        async with append_locks[key]:
+            hit = (await inv_cache.index()).get(key)
+            if not hit:
+                await _append_product(product, stock_type, delta)
+                return
+    row, qty = hit
+    if qty is None:
+        raise BadQuantity(f"Quantity for {product} ({stock_type}) in row {row} isn't a number")
+    # Update the cache first so writes coalesced into the same batch build on each other;
+    # a failed batch invalidates it again
+    inv_cache.set_quantity(row, product, stock_type, qty + delta)
+    await write_quantity(row, qty + delta)
@@ -1,221 +1,354 @@
 import os
-import json
+import asyncio
 import logging
+import secrets
+import hashlib
+import hmac
+from itertools import islice
+from dataclasses import dataclass
 import gspread
-import pytz
-from google.oauth2.service_account import Credentials
-from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-
-# Load and authorize Google Sheets credentials
-SCOPES = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive"
-]
-
-creds_json = os.getenv("GOOGLE_SHEET_CREDENTIALS")
-if not creds_json:
-    raise Exception("GOOGLE_SHEET_CREDENTIALS environment variable not set.")
-
-creds_dict = json.loads(creds_json)
-creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-client = gspread.authorize(creds)
-
-# Start dummy HTTP server for Render health check
-def run_dummy_server():
-    class DummyHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b'Telegram bot is running!')
-    server = HTTPServer(('0.0.0.0', 10000), DummyHandler)
-    server.serve_forever()
-
-threading.Thread(target=run_dummy_server).start()
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, PicklePersistence, PersistenceInput, filters
+from inventory import now_str, inv_cache, todays_logs, warm_caches, log_action, flush_logs, update_inventory, BadQuantity
+
+# Public URL Telegram should push updates to; polling is used when unset.
+# Render provides RENDER_EXTERNAL_URL and PORT for web services.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+PORT = int(os.getenv("PORT", "10000"))
+
+# Answer Render's health check on the bot's own event loop while polling
+HEALTH_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 24\r\nConnection: close\r\n\r\nTelegram bot is running!"
+health_server = None
+
+async def handle_health_check(reader, writer):
+    await reader.read(1024)
+    writer.write(HEALTH_RESPONSE)
+    await writer.drain()
+    writer.close()
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 
-# Timezone
-SG_TIME = pytz.timezone("Asia/Singapore")
-
 # Auth control
 OTP_CODE = "PPLaoBan"
 AUTHORIZED_USERS = set()
 
-# Access sheets
-try:
-    sheet = client.open("PokemonInventory")
-    inv_sheet = sheet.worksheet("Inventory")
-    log_sheet = sheet.worksheet("Logs")
-except Exception as e:
-    raise Exception(f"Failed to access Google Sheet: {e}")
-
-# Log inventory changes
-def log_action(action, product, qty, user, stock_type, note=""):
-    now = datetime.now(SG_TIME).strftime("%d/%m/%Y %H:%M:%S")
-    log_sheet.append_row([now, action, product, stock_type, qty, f"@{user}", note])
-
-# Update inventory count
-def update_inventory(product, stock_type, delta):
-    try:
-        records = inv_sheet.get_all_records()
-        for i, row in enumerate(records, start=2):
-            if row['Product Name'] == product and row['Stock Type'] == stock_type:
-                new_qty = int(row['Quantity']) + delta
-                inv_sheet.update_cell(i, 3, new_qty)
-                return
-        inv_sheet.append_row([product, stock_type, delta])
-    except Exception as e:
-        logging.error(f"Inventory update failed: {e}")
+# Route on login state inside PTB's filters, so handlers only run for the users they serve
+class Authed(filters.MessageFilter):
+    def filter(self, message):
+        user = message.from_user
+        return user is not None and user.id in AUTHORIZED_USERS
+
+class NotAuthed(filters.MessageFilter):
+    def filter(self, message):
+        user = message.from_user
+        return user is not None and user.id not in AUTHORIZED_USERS
+
+AUTHED = Authed()
+NOT_AUTHED = NotAuthed()
+
+# Main menu, built once
+MAIN_MENU_TEXT = "👋 Welcome Laoban to the Pokémon Inventory Bot!\nChoose a command:"
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📥 Add", callback_data='menu_add')],
+    [InlineKeyboardButton("❌ Minus", callback_data='menu_minus')],
+    [InlineKeyboardButton("📦 Open", callback_data='menu_open')],
+    [InlineKeyboardButton("📊 Stock", callback_data='menu_stock')],
+    [InlineKeyboardButton("📈 Report", callback_data='menu_report')],
+])
+
+# Replies for the menu buttons that only explain a command
+BUTTON_USAGE = {
+    "menu_add": "🛒 You chose to *Add* stock.\nSend in the format:\n`/add product_name qty [Loose|Keep Sealed|Bag of 50]`",
+    "menu_minus": "➖ You chose to *Minus* stock.\nSend in the format:\n`/minus product_name qty [Loose|Keep Sealed|Bag of 50]`",
+    "menu_open": "📦 You chose to *Open* a product.\nSend in the format:\n`/open product_name qty stock_type note`",
+    "menu_report": "📈 Generating report...\nUse /report",
+}
 
 # Telegram handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
     user_id = update.effective_user.id
     if user_id in AUTHORIZED_USERS:
-        await send_main_menu(update)
+        await send_main_menu(update, context)
         return
-    await update.message.reply_text("🔐 Please enter the OTP to access the bot.")
+    await reply("🔐 Please enter the OTP to access the bot.")
 
 async def otp_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
     user_id = update.effective_user.id
-    message_text = update.message.text.strip()
-    if user_id in AUTHORIZED_USERS:
-        return
-    if message_text == OTP_CODE:
+    message_text = update.effective_message.text.strip()
+    if hmac.compare_digest(message_text.encode(), OTP_CODE.encode()):
         AUTHORIZED_USERS.add(user_id)
-        await update.message.reply_text("✅ Login successful!")
+        await context.application.update_persistence()
+        await reply("✅ Login successful!")
         await send_main_menu(update, context)
     else:
-        await update.message.reply_text("❌ Invalid OTP. Please try again.")
+        await reply("❌ Invalid OTP. Please try again.")
 
 
 async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("📥 Add", callback_data='menu_add')],
-        [InlineKeyboardButton("❌ Minus", callback_data='menu_minus')],
-        [InlineKeyboardButton("📦 Open", callback_data='menu_open')],
-        [InlineKeyboardButton("📊 Stock", callback_data='menu_stock')],
-        [InlineKeyboardButton("📈 Report", callback_data='menu_report')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if update.callback_query:
+        await update.callback_query.edit_message_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_MARKUP)
+    else:
+        await update.effective_message.reply_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_MARKUP)
 
-    if update.message:
-        await update.message.reply_text("👋 Welcome Laoban to the Pokémon Inventory Bot!\nChoose a command:", reply_markup=reply_markup)
-    elif update.callback_query:
-        await update.callback_query.edit_message_text("👋 Welcome Laoban to the Pokémon Inventory Bot!\nChoose a command:", reply_markup=reply_markup)
 
+# Short, stable id for a product so its callback_data stays under Telegram's 64-byte limit
+def product_id(product):
+    return hashlib.blake2s(product.encode(), digest_size=8).hexdigest()
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
+    # Menus outlive a login, so buttons are gated here like the commands are
+    if update.effective_user.id not in AUTHORIZED_USERS:
+        await query.edit_message_text("🔐 Please enter the OTP to access the bot.")
+        return
+
     command = query.data
-    if command == "menu_add":
-        await query.edit_message_text("🛒 You chose to *Add* stock.\nSend in the format:\n/product [name]", parse_mode="Markdown")
-        # set user step in context.user_data if you want to go multi-step
-    elif command == "menu_minus":
-        await query.edit_message_text("➖ You chose to *Minus* stock.\nSend in the format:\n/product [name]", parse_mode="Markdown")
-    elif command == "menu_open":
-        await query.edit_message_text("📦 You chose to *Open* a product.\nSend in the format:\n/product [name]", parse_mode="Markdown")
+    if command in BUTTON_USAGE:
+        await query.edit_message_text(BUTTON_USAGE[command], parse_mode="Markdown")
     elif command == "menu_stock":
-        await query.edit_message_text("📊 You chose to *View Stock*.\nUse /stock [product_name] or /stock all")
-    elif command == "menu_report":
-        await query.edit_message_text("📈 Generating report...\nUse /report")
+        try:
+            products = await inv_cache.product_names()
+        except gspread.exceptions.APIError as e:
+            logging.error(f"Product list failed: {e}")
+            await query.edit_message_text(SHEET_ERROR)
+            return
+        it = iter(InlineKeyboardButton(p, callback_data=f"stock_{product_id(p)}") for p in products)
+        buttons = [list(islice(it, 3)) for _ in range((len(products) + 2) // 3)]
+        await query.edit_message_text("📊 You chose to *View Stock*.\nPick a product, or use `/stock product_name` or `/stock all`", parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(buttons))
+    elif command.startswith("stock_"):
+        pid = command[len("stock_"):]
+        try:
+            product = next((p for p in await inv_cache.product_names() if product_id(p) == pid), None)
+            matches = (await inv_cache.by_product()).get(product, [])
+        except gspread.exceptions.APIError as e:
+            logging.error(f"Stock lookup failed: {e}")
+            await query.edit_message_text(SHEET_ERROR)
+            return
+        if product is None:
+            await query.edit_message_text("\u274c That product is no longer in the inventory.")
+            return
+        await query.edit_message_text(product_stock_message(product, matches))
     else:
         await query.edit_message_text("Unknown selection.")
 
-    message = f"\ud83d\udccc Usage for `{query.data}`:\n{command_map[query.data]}"
-    await query.edit_message_text(text=message, parse_mode="Markdown")
+ADD_USAGE = "\u2757 Usage: /add product_name qty [Loose|Keep Sealed|Bag of 50]"
+MINUS_USAGE = "\u2757 Usage: /minus product_name qty [Loose|Keep Sealed|Bag of 50]"
+OPEN_USAGE = "\u2757 Usage: /open product_name qty stock_type note"
+STOCK_USAGE = "\u2757 Usage: /stock product_name OR /stock all"
+SHEET_ERROR = "\u26a0\ufe0f Couldn't reach the inventory sheet, please try again."
+BAD_QTY_ERROR = "\u26a0\ufe0f The sheet's Quantity for {} ({}) isn't a number, please fix it there first."
+
+# Known stock types, keyed case-insensitively; some span several words
+STOCK_TYPES = {t.lower(): t for t in ("Loose", "Keep Sealed", "Bag of 50")}
+MAX_STOCK_TYPE_WORDS = max(len(t.split()) for t in STOCK_TYPES)
+
+@dataclass(slots=True)
+class Cmd:
+    product: str
+    qty: int
+    stock_type: str
+    note: str = ""
+
+# Parse "product qty [stock type] [note...]"; returns None when the args don't fit
+def parse_cmd(args, default_stock=None):
+    if len(args) < 2:
+        return None
+    try:
+        qty = int(args[1])
+    except ValueError:
+        return None
+    rest = args[2:]
+    if not rest:
+        return Cmd(args[0], qty, default_stock) if default_stock else None
+    for n in range(min(MAX_STOCK_TYPE_WORDS, len(rest)), 0, -1):
+        stock_type = STOCK_TYPES.get(" ".join(rest[:n]).lower())
+        if stock_type:
+            return Cmd(args[0], qty, stock_type, " ".join(rest[n:]))
+    return None
 
 async def add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
+    cmd = parse_cmd(context.args, default_stock="Loose")
+    if cmd is None:
+        await reply(ADD_USAGE)
+        return
+    user = update.effective_user.username
     try:
-        product = context.args[0]
-        qty = int(context.args[1])
-        stock_type = context.args[2] if len(context.args) > 2 else "Loose"
-        user = update.effective_user.username
-        update_inventory(product, stock_type, qty)
-        log_action("Add", product, qty, user, stock_type)
-        await update.message.reply_text(f"\u2705 Added {qty} of {product} ({stock_type}).")
-    except:
-        await update.message.reply_text("\u2757 Usage: /add product_name qty [Loose|Keep Sealed|Bag of 50]")
+        await update_inventory(cmd.product, cmd.stock_type, cmd.qty)
+    except gspread.exceptions.APIError as e:
+        logging.error(f"Inventory update failed: {e}")
+        await reply(SHEET_ERROR)
+        return
+    except BadQuantity:
+        await reply(BAD_QTY_ERROR.format(cmd.product, cmd.stock_type))
+        return
+    await log_action("Add", cmd.product, cmd.qty, user, cmd.stock_type)
+    await reply(f"\u2705 Added {cmd.qty} of {cmd.product} ({cmd.stock_type}).")
 
 async def minus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
+    cmd = parse_cmd(context.args, default_stock="Loose")
+    if cmd is None:
+        await reply(MINUS_USAGE)
+        return
+    user = update.effective_user.username
     try:
-        product = context.args[0]
-        qty = int(context.args[1])
-        stock_type = context.args[2] if len(context.args) > 2 else "Loose"
-        user = update.effective_user.username
-        update_inventory(product, stock_type, -qty)
-        log_action("Minus", product, qty, user, stock_type)
-        await update.message.reply_text(f"\u274c Subtracted {qty} of {product} ({stock_type}).")
-    except:
-        await update.message.reply_text("\u2757 Usage: /minus product_name qty [Loose|Keep Sealed|Bag of 50]")
+        await update_inventory(cmd.product, cmd.stock_type, -cmd.qty)
+    except gspread.exceptions.APIError as e:
+        logging.error(f"Inventory update failed: {e}")
+        await reply(SHEET_ERROR)
+        return
+    except BadQuantity:
+        await reply(BAD_QTY_ERROR.format(cmd.product, cmd.stock_type))
+        return
+    await log_action("Minus", cmd.product, cmd.qty, user, cmd.stock_type)
+    await reply(f"\u274c Subtracted {cmd.qty} of {cmd.product} ({cmd.stock_type}).")
 
 async def open_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
+    cmd = parse_cmd(context.args)
+    if cmd is None:
+        await reply(OPEN_USAGE)
+        return
+    note = cmd.note or "Opened for singles"
+    user = update.effective_user.username
     try:
-        product = context.args[0]
-        qty = int(context.args[1])
-        stock_type = context.args[2]
-        note = ' '.join(context.args[3:]) or "Opened for singles"
-        user = update.effective_user.username
-        update_inventory(product, stock_type, -qty)
-        log_action("Open", product, qty, user, stock_type, note)
-        await update.message.reply_text(f"\ud83d\udce6 Opened {qty} of {product} ({stock_type}) - {note}")
-    except:
-        await update.message.reply_text("\u2757 Usage: /open product_name qty stock_type note")
+        await update_inventory(cmd.product, cmd.stock_type, -cmd.qty)
+    except gspread.exceptions.APIError as e:
+        logging.error(f"Inventory update failed: {e}")
+        await reply(SHEET_ERROR)
+        return
+    except BadQuantity:
+        await reply(BAD_QTY_ERROR.format(cmd.product, cmd.stock_type))
+        return
+    await log_action("Open", cmd.product, cmd.qty, user, cmd.stock_type, note)
+    await reply(f"\ud83d\udce6 Opened {cmd.qty} of {cmd.product} ({cmd.stock_type}) - {note}")
+
+# Telegram caps messages at 4096 chars; split long output and pace the sends
+MAX_MESSAGE_LEN = 4000
+
+async def send_long(reply, header, lines):
+    chunk, size = [header], len(header)
+    for line in lines:
+        if size + len(line) + 1 > MAX_MESSAGE_LEN:
+            await reply("\n".join(chunk))
+            await asyncio.sleep(0.05)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    await reply("\n".join(chunk))
+
+def product_stock_message(product, matches):
+    if not matches:
+        return f"\u274c No data found for {product}"
+    lines = [f"- {stock_type}: {qty}" for _, stock_type, qty in matches]
+    return f"\ud83d\udce6 Stock for {product}:\n" + "\n".join(lines)
 
 async def stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply = update.effective_message.reply_text
+    args = context.args
+    if not args:
+        await reply(STOCK_USAGE)
+        return
+    show_all = args[0].lower() == "all"
     try:
-        if context.args[0].lower() == "all":
-            all_data = inv_sheet.get_all_records()
-            msg = "\ud83d\udccb Current Stock:\n"
-            for item in all_data:
-                msg += f"- {item['Product Name']} ({item['Stock Type']}): {item['Quantity']}\n"
+        if show_all:
+            all_data = await inv_cache.records()
         else:
-            product = context.args[0]
-            all_data = inv_sheet.get_all_records()
-            matches = [i for i in all_data if i['Product Name'] == product]
-            if not matches:
-                msg = f"\u274c No data found for {product}"
-            else:
-                msg = f"\ud83d\udce6 Stock for {product}:\n"
-                for i in matches:
-                    msg += f"- {i['Stock Type']}: {i['Quantity']}\n"
-        await update.message.reply_text(msg)
-    except:
-        await update.message.reply_text("\u2757 Usage: /stock product_name OR /stock all")
+            matches = (await inv_cache.by_product()).get(args[0], [])
+    except gspread.exceptions.APIError as e:
+        logging.error(f"Stock lookup failed: {e}")
+        await reply(SHEET_ERROR)
+        return
+    if show_all:
+        lines = [f"- {product} ({stock_type}): {qty}" for product, stock_type, qty in all_data]
+        await send_long(reply, "\ud83d\udccb Current Stock:", lines)
+    else:
+        await reply(product_stock_message(args[0], matches))
 
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    today = datetime.now(SG_TIME).strftime("%d/%m/%Y")
-    records = log_sheet.get_all_records()
-    today_logs = [r for r in records if r['Timestamp'].startswith(today)]
+    reply = update.effective_message.reply_text
+    today = now_str()[:10]
+    try:
+        today_logs = await todays_logs()
+    except gspread.exceptions.APIError as e:
+        logging.error(f"Report lookup failed: {e}")
+        await reply(SHEET_ERROR)
+        return
     if not today_logs:
-        await update.message.reply_text("\ud83d\udc6d No activity logged today.")
+        await reply("\ud83d\udc6d No activity logged today.")
         return
 
-    msg = f"\ud83d\udcc8 Daily Report for {today}:\n"
-    for log in today_logs:
-        note = f"({log['Note']})" if log['Note'] else ""
-        msg += f"{log['Timestamp']} - {log['Action']} {log['Quantity']}x {log['Product']} ({log['Stock Type']}) by {log['User']} {note}\n"
-    await update.message.reply_text(msg)
+    lines = [
+        f"{log['Timestamp']} - {log['Action']} {log['Quantity']}x {log['Product']} ({log['Stock Type']}) by {log['User']} "
+        + (f"({log['Note']})" if log['Note'] else "")
+        for log in today_logs
+    ]
+    await send_long(reply, f"\ud83d\udcc8 Daily Report for {today}:", lines)
+
+async def post_init(application):
+    # Logged-in users live in bot_data so they survive restarts
+    AUTHORIZED_USERS.update(application.bot_data.get("auth", ()))
+    application.bot_data["auth"] = AUTHORIZED_USERS
+    if not WEBHOOK_URL:
+        global health_server
+        health_server = await asyncio.start_server(handle_health_check, "0.0.0.0", PORT)
+    try:
+        await warm_caches()
+    except Exception as e:
+        # Not fatal: the inventory cache and today's logs also load on first use
+        logging.error(f"Warming caches failed: {e}")
+
+async def post_shutdown(application):
+    await flush_logs()
+    if health_server:
+        health_server.close()
+        await health_server.wait_closed()
 
 if __name__ == '__main__':
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     if not TOKEN:
         raise Exception("TELEGRAM_BOT_TOKEN environment variable not found!")
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    persistence = PicklePersistence(
+        filepath=os.getenv("BOT_STATE_FILE", "bot_state.pickle"),
+        store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+    )
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.job_queue.run_repeating(flush_logs, interval=5.0)
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("add", add))
-    app.add_handler(CommandHandler("minus", minus))
-    app.add_handler(CommandHandler("open", open_product))
-    app.add_handler(CommandHandler("stock", stock))
-    app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler("add", add, filters=AUTHED))
+    app.add_handler(CommandHandler("minus", minus, filters=AUTHED))
+    app.add_handler(CommandHandler("open", open_product, filters=AUTHED))
+    app.add_handler(CommandHandler("stock", stock, filters=AUTHED))
+    app.add_handler(CommandHandler("report", report, filters=AUTHED))
     app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, otp_handler))
-    print("Starting Telegram bot...")
-    app.run_polling()
+    # Anything from a user who hasn't logged in yet goes to the OTP prompt
+    app.add_handler(MessageHandler(filters.COMMAND & NOT_AUTHED, start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & NOT_AUTHED, otp_handler))
+
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; the webhook server also binds Render's port
+        WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+        print("Starting Telegram bot (webhook)...")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        print("Starting Telegram bot...")
+        app.run_polling()